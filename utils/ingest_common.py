@@ -0,0 +1,207 @@
+"""
+Helpers shared by the ingest scripts: settings, row-to-document conversion,
+embedding setup, retries and failed-batch logging.
+"""
+
+import os
+import re
+import json
+import random
+import httpx
+import numpy as np
+import polars as pl
+import xxhash
+from collections.abc import Awaitable
+from pathlib import Path
+from chromadb import Collection
+from typing import TypeVar
+from langchain_openai import OpenAIEmbeddings
+from langchain.embeddings import CacheBackedEmbeddings
+from langchain.storage import LocalFileStore
+from langchain_core.embeddings import Embeddings
+from dotenv import load_dotenv
+from openai import APIConnectionError, InternalServerError, RateLimitError
+from tenacity import AsyncRetrying, RetryCallState, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
+
+load_dotenv()
+
+T = TypeVar("T")
+
+# Maximum number of embedding batches in flight at once (tune to your OpenAI rate-limit tier)
+MAX_CONCURRENT_BATCHES = int(os.getenv("EMBEDDING_MAX_CONCURRENCY", "35"))
+
+# CSV columns stored as Chroma metadata for filtering (comma-separated); other columns only appear in the text
+FILTERABLE_COLUMNS = {col.strip() for col in os.getenv("FILTERABLE_COLUMNS", "product_id,category,price").split(",") if col.strip()}
+
+# Rows sampled from the start of a CSV file to infer its column types
+INFER_SCHEMA_LENGTH = 10_000
+
+# Texts per OpenAI embeddings request (the API accepts up to 2048 inputs)
+EMBEDDING_CHUNK_SIZE = 2048
+
+# Connection pool shared by every embedding request; HTTP/2 multiplexes the requests over few connections
+HTTP_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=32)
+
+# Rows per Chroma write, which bounds the size of each SQLite transaction
+CHROMA_BATCH_SIZE = 1000
+
+# Transient OpenAI errors worth retrying: rate limits, dropped connections and 5xx responses
+RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, InternalServerError, httpx.HTTPError)
+
+# Longest single wait between retries, in seconds
+MAX_RETRY_WAIT = 60
+
+# Backoff used for 5xx and connection errors, and for 429s that don't say when the limit resets
+backoff_with_jitter = wait_exponential_jitter(initial=1, max=MAX_RETRY_WAIT)
+
+def infer_csv_schema(file_path: str) -> pl.Schema:
+    """Infer the column types of a CSV file from its first INFER_SCHEMA_LENGTH rows, without reading the rest."""
+    return pl.scan_csv(file_path, infer_schema_length=INFER_SCHEMA_LENGTH).collect_schema()
+
+def build_documents(df: pl.DataFrame, file_path: str, schema: pl.Schema, row_offset: int = 0) -> tuple[list[str], list[dict], list[str]]:
+    """Convert each row of a CSV DataFrame to a document's text, metadata and id.
+
+    df holds the raw CSV values as strings and schema gives the column types sampled by
+    infer_csv_schema. Numeric columns are cast non-strictly, so a value that doesn't fit
+    the sampled type (say a late decimal in an integer column) keeps its raw text and is
+    left out of that row's metadata instead of failing the file. Rows are returned as parallel lists (texts, metadatas, ids) that can be passed
+    straight to a Chroma collection. row_offset is the file row index of the first row
+    in df. Each id is derived from the file name and row index only, so a re-run maps
+    every row onto the document it wrote last time and an edited row replaces it.
+    """
+    # File name and metadata that are the same for every row of this file are built once
+    basename = os.path.basename(file_path)
+    base_metadata = {
+        "source": basename,
+        "file_path": file_path
+    }
+    row_indices = range(row_offset, row_offset + len(df))
+    typed = {col: pl.col(col).cast(schema[col], strict=False) if schema[col].is_numeric() else pl.col(col) for col in df.columns}
+
+    # Build "col: val | col: val" content for every row in a single expression, falling back to the raw value where a cast failed
+    texts = df.select(
+        pl.concat_str([pl.lit(f"{col}: ") + pl.coalesce(typed[col].cast(pl.String), pl.col(col)).fill_null("") for col in df.columns], separator=" | ")
+    ).to_series().to_list()
+
+    # Only filterable columns go into metadata; every column is still searchable through the text
+    filterable = [col for col in df.columns if col in FILTERABLE_COLUMNS]
+    records = df.select([typed[col] for col in filterable]).to_dicts() if filterable else [{}] * len(df)
+
+    # Chroma metadata can't hold nulls, so empty or unparsable values are left out of the row's metadata
+    metadatas = [
+        {**base_metadata, "row_index": index, **{col: val for col, val in record.items() if val is not None}}
+        for index, record in zip(row_indices, records)
+    ]
+
+    # xxh3 is far cheaper than a cryptographic hash, and ids only need to be unique per row position
+    ids = [xxhash.xxh3_64_hexdigest(f"{basename}:{index}".encode()) for index in row_indices]
+
+    return texts, metadatas, ids
+
+def find_changed_rows(collection: Collection, ids: list[str], texts: list[str], metadatas: list[dict]) -> list[tuple[str, str, dict]]:
+    """Return the (id, text, metadata) rows that are missing from collection or whose stored text or metadata differs.
+
+    Metadata is compared too, so changing FILTERABLE_COLUMNS or moving the data directory
+    rewrites the affected rows. Changed rows are upserted under their existing id, so
+    they replace the old version. An upsert merges metadata into the stored record, so
+    rows whose stored metadata has keys the new metadata lacks are deleted here first.
+    """
+    found = collection.get(ids=ids, include=["documents", "metadatas"])
+    stored = {id_: (document, metadata) for id_, document, metadata in zip(found["ids"], found["documents"], found["metadatas"])}
+    changed = [row for row in zip(ids, texts, metadatas) if stored.get(row[0]) != (row[1], row[2])]
+
+    stale_keys = [id_ for id_, _, metadata in changed if id_ in stored and stored[id_][1].keys() - metadata.keys()]
+    if stale_keys:
+        collection.delete(ids=stale_keys)
+
+    return changed
+
+def delete_rows_past_end(collection: Collection, source: str, row_count: int):
+    """Delete rows of source whose row index is past the end of the file, left over from a longer earlier version."""
+    collection.delete(where={"$and": [{"source": source}, {"row_index": {"$gte": row_count}}]})
+
+def create_embeddings(embedding_model: str, api_key: str, http_client: httpx.Client, http_async_client: httpx.AsyncClient) -> Embeddings:
+    """Create OpenAI embeddings backed by an on-disk cache shared by both ingest scripts.
+
+    Requests go through the given keep-alive HTTP clients, which the caller closes once
+    ingestion finishes.
+    """
+    openai_embeddings = OpenAIEmbeddings(
+        model=embedding_model,
+        api_key=api_key,
+        http_client=http_client,
+        http_async_client=http_async_client,
+        chunk_size=EMBEDDING_CHUNK_SIZE,
+        # embed_with_retry owns retries, so the SDK's own retries don't multiply them
+        max_retries=0
+    )
+
+    # Cache embeddings on disk, keyed by a hash of the text, so both ingest scripts reuse them
+    embedding_cache = LocalFileStore(str(Path(__file__).parent.parent / ".emb_cache" / embedding_model))
+    return CacheBackedEmbeddings.from_bytes_store(
+        openai_embeddings,
+        embedding_cache,
+        namespace=embedding_model,
+        key_encoder="sha256"
+    )
+
+async def close_after(http_async_client: httpx.AsyncClient, ingest: Awaitable[T]) -> T:
+    """Await ingest, then close http_async_client on the event loop whose connections it holds."""
+    async with http_async_client:
+        return await ingest
+
+def parse_reset_duration(value: str) -> float | None:
+    """Parse an OpenAI rate-limit reset duration such as "20ms", "1s" or "6m0s" into seconds."""
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", value)
+    if not parts:
+        return None
+    return sum(float(amount) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit] for amount, unit in parts)
+
+def wait_for_rate_limit_reset(retry_state: RetryCallState) -> float:
+    """Wait out an exhausted rate limit on a 429, else back off exponentially with jitter.
+
+    Only a RateLimitError's headers are trusted: OpenAI sends the x-ratelimit-reset-*
+    headers on every response, but they only say when to retry for the limit whose
+    x-ratelimit-remaining-* is 0. Jitter keeps workers that hit the same 429 from all
+    retrying at the same moment.
+    """
+    error = retry_state.outcome.exception()
+    if isinstance(error, RateLimitError):
+        headers = error.response.headers
+        if (retry_after := headers.get("retry-after")) and retry_after.replace(".", "", 1).isdigit():
+            reset = float(retry_after)
+        else:
+            resets = [
+                parse_reset_duration(headers.get(f"x-ratelimit-reset-{limit}", ""))
+                for limit in ("requests", "tokens")
+                if headers.get(f"x-ratelimit-remaining-{limit}") == "0"
+            ]
+            resets = [reset for reset in resets if reset is not None]
+            reset = max(resets) if resets else None
+        if reset is not None:
+            return min(reset + random.uniform(0, 1), MAX_RETRY_WAIT)
+    return backoff_with_jitter(retry_state)
+
+async def embed_with_retry(embeddings: Embeddings, texts: list[str]) -> np.ndarray:
+    """Embed texts, retrying rate limits and transient API errors with backoff.
+
+    Vectors are returned as one float32 array, the precision Chroma stores them in, so
+    they are handed to Chroma without building a Python float object per dimension.
+    """
+    async for attempt in AsyncRetrying(
+        retry=retry_if_exception_type(RETRYABLE_ERRORS),
+        wait=wait_for_rate_limit_reset,
+        stop=stop_after_attempt(6),
+        reraise=True
+    ):
+        with attempt:
+            return np.asarray(await embeddings.aembed_documents(texts), dtype=np.float32)
+
+def record_failed_batch(failed_batches_path: Path, collection_name: str, ids: list[str], error: Exception):
+    """Append a batch that failed after all retries to failed_batches_path, one JSON object per line.
+
+    Re-running the script retries these rows, since every row missing from the collection is embedded.
+    """
+    failed_batches_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(failed_batches_path, "a") as f:
+        f.write(json.dumps({"collection": collection_name, "ids": ids, "error": str(error)}) + "\n")
@@ -5,39 +5,34 @@ Each CSV file gets its own collection, with each row becoming a document.
 """
 
 import os
-import pandas as pd
+import asyncio
+import argparse
+import httpx
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
+import chromadb
+import polars as pl
+from chromadb.api import ClientAPI
 from langchain_chroma import Chroma
-from langchain_openai import OpenAIEmbeddings
-from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
 from dotenv import load_dotenv
 from tqdm import tqdm
+from ingest_common import CHROMA_BATCH_SIZE, HTTP_LIMITS, MAX_CONCURRENT_BATCHES, build_documents, close_after, create_embeddings, delete_rows_past_end, embed_with_retry, find_changed_rows, infer_csv_schema, record_failed_batch
 
 load_dotenv()
 
-def load_csv_as_documents(file_path: str) -> list[Document]:
-    """Load CSV file and convert each row to a Document."""
-    df = pd.read_csv(file_path)
-    documents = []
+# Batches buffered between pipeline stages, which bounds the memory held in flight
+QUEUE_DEPTH = 2
 
-    for index, row in tqdm(df.iterrows(), total=len(df), desc=f"Processing {os.path.basename(file_path)}"):
-        # Convert row to string representation
-        content = " | ".join([f"{col}: {val}" for col, val in row.items()])
+# Batches that still fail after every retry are logged here, one JSON object per line
+FAILED_BATCHES_PATH = Path(__file__).parent.parent / "vector_store" / "chroma_db_separate.failed.jsonl"
 
-        # Create metadata with source file and row index
-        metadata = {
-            "source": os.path.basename(file_path),
-            "row_index": index,
-            "file_path": file_path
-        }
-
-        # Add individual columns as metadata for better filtering
-        for col, val in row.items():
-            metadata[col] = val
-
-        documents.append(Document(page_content=content, metadata=metadata))
-
-    return documents
+def load_csv_as_documents(file_path: str) -> tuple[list[str], list[dict], list[str]]:
+    """Load CSV file and convert each row to a document's text, metadata and id."""
+    # Polars parses the file multi-threaded into raw string columns; types come from a sample of the first rows,
+    # the same way the single-collection script streams files
+    return build_documents(pl.read_csv(file_path, infer_schema=False), file_path, infer_csv_schema(file_path))
 
 def get_collection_name(file_path: str) -> str:
     """Generate collection name from file path."""
@@ -46,18 +41,137 @@ def get_collection_name(file_path: str) -> str:
     collection_name = filename.replace(" ", "_").replace("-", "_").lower()
     return collection_name
 
+async def ingest_pipeline(collection_names: dict[Path, str], embeddings: Embeddings, client: ClientAPI, bulk_load: bool = False) -> dict[str, int]:
+    """Ingest CSV files into their collections through a load -> embed -> write pipeline.
+
+    Files are processed concurrently: CSV parsing and Chroma lookups run in worker threads
+    (polars parses multi-threaded outside the GIL), embedding requests run concurrently
+    and a single writer upserts the precomputed vectors (all collections share one SQLite
+    database), so parsing, network and disk work overlap across files.
+    Rows already stored with the same text are skipped, rows left over from a longer
+    earlier version of a file are deleted, and batches that still fail after retrying
+    are recorded in FAILED_BATCHES_PATH. With bulk_load, each write uses the largest
+    batch Chroma accepts instead of CHROMA_BATCH_SIZE.
+    collection_names maps each CSV file to its collection.
+    Returns the number of documents written to each collection.
+    """
+    loop = asyncio.get_running_loop()
+    embed_queue = asyncio.Queue(maxsize=QUEUE_DEPTH)
+    write_queue = asyncio.Queue(maxsize=QUEUE_DEPTH)
+    ingested = {}
+    progress = tqdm(desc="Ingesting documents", unit="doc")
+
+    async def process_one_file(csv_file: Path, collection_name: str, threads: ThreadPoolExecutor):
+        """Load one CSV file and queue its new rows for embedding."""
+        try:
+            print(f"\nProcessing {csv_file.name} -> collection: {collection_name}")
+
+            texts, metadatas, ids = await asyncio.to_thread(load_csv_as_documents, str(csv_file))
+
+            # Create vector store for this collection; Chroma client calls block, so they run in the thread pool
+            vector_store = await loop.run_in_executor(threads, partial(
+                Chroma,
+                client=client,
+                collection_name=collection_name,
+                embedding_function=embeddings
+            ))
+            ingested[collection_name] = 0
+
+            # Ids are row positions, so a file that shrank (even to just its header) leaves its old tail behind
+            await loop.run_in_executor(threads, delete_rows_past_end, vector_store._collection, csv_file.name, len(ids))
+
+            if not ids:
+                print(f"  No documents found in {csv_file.name}")
+                return
+
+            # Chroma commits one SQLite transaction per write, so bulk loads use the largest batch it accepts
+            batch_size = client.get_max_batch_size() if bulk_load else CHROMA_BATCH_SIZE
+
+            print(f"  Ingesting {len(ids)} documents into collection '{collection_name}'...")
+
+            for i in range(0, len(ids), batch_size):
+                batch = slice(i, i+batch_size)
+
+                # Only embed rows that are new or whose content changed since they were stored
+                rows = await loop.run_in_executor(threads, find_changed_rows, vector_store._collection, ids[batch], texts[batch], metadatas[batch])
+                if rows:
+                    await embed_queue.put((collection_name, vector_store, *map(list, zip(*rows))))
+
+        except Exception as e:
+            print(f"  Error processing {csv_file.name}: {e}")
+
+    async def produce():
+        # Every file is parsed and checked against its collection concurrently
+        with ThreadPoolExecutor(max_workers=min(8, len(collection_names))) as threads:
+            await asyncio.gather(*(
+                process_one_file(csv_file, collection_name, threads)
+                for csv_file, collection_name in collection_names.items()
+            ))
+
+    async def embed():
+        while (item := await embed_queue.get()) is not None:
+            collection_name, vector_store, batch_ids, batch_texts, batch_metadatas = item
+            try:
+                vectors = await embed_with_retry(embeddings, batch_texts)
+            except Exception as e:
+                print(f"  Error embedding batch for collection '{collection_name}': {e}")
+                record_failed_batch(FAILED_BATCHES_PATH, collection_name, batch_ids, e)
+                continue
+
+            await write_queue.put((collection_name, vector_store, batch_ids, batch_texts, batch_metadatas, vectors))
+
+    async def write():
+        while (item := await write_queue.get()) is not None:
+            collection_name, vector_store, batch_ids, batch_texts, batch_metadatas, vectors = item
+            try:
+                # Write precomputed vectors directly so Chroma doesn't re-embed in smaller batches
+                await asyncio.to_thread(
+                    vector_store._collection.upsert,
+                    ids=batch_ids,
+                    documents=batch_texts,
+                    metadatas=batch_metadatas,
+                    embeddings=vectors
+                )
+                ingested[collection_name] += len(batch_ids)
+                progress.update(len(batch_ids))
+            except Exception as e:
+                print(f"  Error writing batch to collection '{collection_name}': {e}")
+                record_failed_batch(FAILED_BATCHES_PATH, collection_name, batch_ids, e)
+
+    # The number of embedding workers bounds the embedding requests in flight
+    embedders = [asyncio.create_task(embed()) for _ in range(MAX_CONCURRENT_BATCHES)]
+    writer = asyncio.create_task(write())
+
+    try:
+        await produce()
+        for _ in embedders:
+            await embed_queue.put(None)
+        await asyncio.gather(*embedders)
+        await write_queue.put(None)
+        await writer
+    finally:
+        progress.close()
+
+    return ingested
+
 def main():
     """Main function to ingest each data file into its own ChromaDB collection."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--bulk-load", action="store_true", help="Write each Chroma batch in the largest single transaction Chroma accepts (fewer commits, more memory per write)")
+    args = parser.parse_args()
+
     # Get OpenAI API key from environment
     openai_api_key = os.getenv("OPENAI_API_KEY")
     if not openai_api_key:
         raise ValueError("OPENAI_API_KEY environment variable is required")
 
     # Initialize embeddings model
-    embeddings = OpenAIEmbeddings(
-        model=os.getenv("OPENAI_EMBEDDING_MODEL", "text-embedding-3-small"),
-        api_key=openai_api_key
-    )
+    embedding_model = os.getenv("OPENAI_EMBEDDING_MODEL", "text-embedding-3-small")
+
+    # One keep-alive HTTP/2 connection pool for every embedding request, closed once ingestion finishes
+    http_client = httpx.Client(http2=True, limits=HTTP_LIMITS)
+    http_async_client = httpx.AsyncClient(http2=True, limits=HTTP_LIMITS)
+    embeddings = create_embeddings(embedding_model, openai_api_key, http_client, http_async_client)
 
     # Setup ChromaDB directory
     chroma_db_path = Path(__file__).parent.parent / "vector_store" / "chroma_db_separate"
@@ -73,47 +187,22 @@ def main():
 
     print(f"Found {len(csv_files)} CSV files to process into separate collections")
 
-    # Process each CSV file into its own collection
-    for csv_file in tqdm(csv_files, desc="Processing CSV files"):
-        try:
-            # Generate collection name from filename
-            collection_name = get_collection_name(str(csv_file))
-
-            print(f"\nProcessing {csv_file.name} -> collection: {collection_name}")
-
-            # Load documents from CSV
-            documents = load_csv_as_documents(str(csv_file))
+    # Generate each collection name from its filename once
+    collection_names = {csv_file: get_collection_name(str(csv_file)) for csv_file in csv_files}
 
-            if not documents:
-                print(f"  No documents found in {csv_file.name}")
-                continue
-
-            # Create vector store for this collection
-            vector_store = Chroma(
-                collection_name=collection_name,
-                embedding_function=embeddings,
-                persist_directory=str(chroma_db_path)
-            )
-
-            # Add documents to the collection in batches
-            batch_size = 100
-            total_batches = len(documents) // batch_size + (1 if len(documents) % batch_size else 0)
+    # One client is shared by every collection so concurrent files don't each open the database
+    client = chromadb.PersistentClient(path=str(chroma_db_path))
 
-            print(f"  Ingesting {len(documents)} documents into collection '{collection_name}'...")
+    # Load, embed and write every CSV file into its own collection
+    with http_client:
+        ingested = asyncio.run(close_after(http_async_client, ingest_pipeline(collection_names, embeddings, client, bulk_load=args.bulk_load)))
 
-            for i in tqdm(range(0, len(documents), batch_size), desc=f"Ingesting {collection_name}", total=total_batches):
-                batch = documents[i:i+batch_size]
-                vector_store.add_documents(batch)
-
-            print(f"  Successfully ingested {len(documents)} documents into collection '{collection_name}'")
-
-        except Exception as e:
-            print(f"  Error processing {csv_file.name}: {e}")
+    for collection_name, count in ingested.items():
+        print(f"  Successfully ingested {count} new or changed documents into collection '{collection_name}'")
 
     print(f"\nAll collections persisted to: {chroma_db_path}")
     print("Collections created:")
-    for csv_file in csv_files:
-        collection_name = get_collection_name(str(csv_file))
+    for csv_file, collection_name in collection_names.items():
         print(f"  - {collection_name} (from {csv_file.name})")
 
 if __name__ == "__main__":
@@ -5,52 +5,187 @@ Each row in the CSV files becomes a separate document in the collection.
 """
 
 import os
-import pandas as pd
+import asyncio
+import argparse
+import queue
+import threading
+import httpx
+import polars as pl
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from itertools import batched
 from pathlib import Path
 from langchain_chroma import Chroma
-from langchain_openai import OpenAIEmbeddings
-from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
 from dotenv import load_dotenv
 from tqdm import tqdm
+from ingest_common import CHROMA_BATCH_SIZE, HTTP_LIMITS, MAX_CONCURRENT_BATCHES, build_documents, close_after, create_embeddings, delete_rows_past_end, embed_with_retry, find_changed_rows, infer_csv_schema, record_failed_batch
 
 load_dotenv()
 
-def load_csv_as_documents(file_path: str) -> list[Document]:
-    """Load CSV file and convert each row to a Document."""
-    df = pd.read_csv(file_path)
-    documents = []
-    
-    for index, row in tqdm(df.iterrows(), total=len(df), desc=f"Processing {os.path.basename(file_path)}"):
-        # Convert row to string representation
-        content = " | ".join([f"{col}: {val}" for col, val in row.items()])
-        
-        # Create metadata with source file and row index
-        metadata = {
-            "source": os.path.basename(file_path),
-            "row_index": index,
-            "file_path": file_path
-        }
-        
-        # Add individual columns as metadata for better filtering
-        for col, val in row.items():
-            metadata[col] = val
-        
-        documents.append(Document(page_content=content, metadata=metadata))
+# Rows read from a CSV file at a time, which bounds the memory used while parsing
+CSV_CHUNK_SIZE = 10_000
+
+# CSV files parsed at once; each parser thread hands its chunks to the ingest through a bounded queue
+PARSE_WORKERS = 4
+
+# Batches that still fail after every retry are logged here, one JSON object per line
+FAILED_BATCHES_PATH = Path(__file__).parent.parent / "vector_store" / "chroma_db_single.failed.jsonl"
+
+def iter_csv_documents(file_path: str, chunk_size: int = CSV_CHUNK_SIZE) -> Iterator[tuple[list[str], list[dict], list[str]]]:
+    """Stream a CSV file as chunks of document texts, metadatas and ids.
     
-    return documents
+    Each chunk is a tuple of parallel lists (texts, metadatas, ids) that can be passed
+    straight to a Chroma collection, so only chunk_size rows are held in memory at once.
+    """
+    # Polars streams the file in chunks of raw string columns; types come from a sample of the first rows,
+    # since inferring them from the whole file would load all of it into memory
+    schema = infer_csv_schema(file_path)
+    offset = 0
+    for df in pl.scan_csv(file_path, infer_schema=False).collect_batches(chunk_size=chunk_size):
+        yield build_documents(df, file_path, schema, row_offset=offset)
+        offset += len(df)
+
+def iter_rows(csv_files: list[Path], row_counts: dict[str, int]) -> Iterator[tuple[str, dict, str]]:
+    """Yield (text, metadata, id) for every row of every CSV file, reporting per-file errors.
+    
+    The row count of each file that loads completely is recorded in row_counts by file name.
+    
+    Up to PARSE_WORKERS files are parsed at once in worker threads (polars parses outside
+    the GIL), and their chunks are handed over through a queue of PARSE_WORKERS chunks,
+    so parsing keeps running ahead of the ingest without holding whole files in memory.
+    """
+    chunks = queue.Queue(maxsize=PARSE_WORKERS)
+    stop = threading.Event()
+    file_done = object()
+    
+    def put(item):
+        # Give up once the consumer has stopped, so a worker never blocks on a full queue forever
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+    
+    def parse(csv_file: Path):
+        if stop.is_set():
+            return
+        loaded = 0
+        try:
+            for chunk in iter_csv_documents(str(csv_file)):
+                put(chunk)
+                if stop.is_set():
+                    return
+                loaded += len(chunk[2])
+            row_counts[csv_file.name] = loaded
+            print(f"  Loaded {loaded} documents from {csv_file.name}")
+        except Exception as e:
+            print(f"  Error processing {csv_file.name}: {e}")
+        finally:
+            put(file_done)
+    
+    with ThreadPoolExecutor(max_workers=min(PARSE_WORKERS, len(csv_files))) as executor:
+        for csv_file in csv_files:
+            executor.submit(parse, csv_file)
+        try:
+            remaining = len(csv_files)
+            while remaining:
+                chunk = chunks.get()
+                if chunk is file_done:
+                    remaining -= 1
+                    continue
+                yield from zip(*chunk)
+        finally:
+            stop.set()
+
+async def ingest_async(batches: Iterable[tuple[list[str], list[dict], list[str]]], vector_store: Chroma, embeddings: Embeddings) -> int:
+    """Embed and write streamed (texts, metadatas, ids) batches concurrently, retrying transient API errors.
+    
+    At most MAX_CONCURRENT_BATCHES batches are pulled from the stream and held in memory
+    at once. The stream is pulled and Chroma is called in worker threads, so CSV parsing
+    and disk work never stall the embedding requests in flight. Rows already stored with
+    the same text are skipped, and batches that still fail to embed after retrying, or
+    fail to be looked up or written, are recorded in FAILED_BATCHES_PATH instead of
+    aborting the run. Returns the number of documents written.
+    """
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_BATCHES)
+    progress = tqdm(desc="Ingesting documents", unit="doc")
+    tasks = []
+    ingested = 0
+    
+    async def _one(texts: list[str], metadatas: list[dict], ids: list[str]):
+        nonlocal ingested
+        try:
+            # Only embed rows that are new or whose content changed since they were stored
+            try:
+                rows = await asyncio.to_thread(find_changed_rows, vector_store._collection, ids, texts, metadatas)
+            except Exception as e:
+                print(f"  Error looking up batch of {len(ids)} documents: {e}")
+                record_failed_batch(FAILED_BATCHES_PATH, vector_store._collection.name, ids, e)
+                return
+            
+            if rows:
+                batch_ids, batch_texts, batch_metadatas = map(list, zip(*rows))
+                try:
+                    vectors = await embed_with_retry(embeddings, batch_texts)
+                except Exception as e:
+                    print(f"  Error embedding batch of {len(batch_ids)} documents: {e}")
+                    record_failed_batch(FAILED_BATCHES_PATH, vector_store._collection.name, batch_ids, e)
+                    return
+                
+                try:
+                    # Write precomputed vectors directly so Chroma doesn't re-embed in smaller batches
+                    await asyncio.to_thread(
+                        vector_store._collection.upsert,
+                        ids=batch_ids,
+                        documents=batch_texts,
+                        metadatas=batch_metadatas,
+                        embeddings=vectors
+                    )
+                    ingested += len(batch_ids)
+                except Exception as e:
+                    print(f"  Error writing batch of {len(batch_ids)} documents: {e}")
+                    record_failed_batch(FAILED_BATCHES_PATH, vector_store._collection.name, batch_ids, e)
+        finally:
+            progress.update(len(ids))
+            semaphore.release()
+    
+    try:
+        # Pull the next batch only once a slot is free, so the stream is consumed as fast as it is ingested;
+        # the stream parses CSV chunks, so it is pulled in a worker thread to keep the event loop free
+        batches = iter(batches)
+        while True:
+            await semaphore.acquire()
+            batch = await asyncio.to_thread(next, batches, None)
+            if batch is None:
+                semaphore.release()
+                break
+            tasks.append(asyncio.create_task(_one(*batch)))
+        await asyncio.gather(*tasks)
+    finally:
+        progress.close()
+    
+    return ingested
 
 def main():
     """Main function to ingest all data files into ChromaDB."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--bulk-load", action="store_true", help="Write each Chroma batch in the largest single transaction Chroma accepts (fewer commits, more memory per write)")
+    args = parser.parse_args()
+    
     # Get OpenAI API key from environment
     openai_api_key = os.getenv("OPENAI_API_KEY")
     if not openai_api_key:
         raise ValueError("OPENAI_API_KEY environment variable is required")
     
     # Initialize embeddings model
-    embeddings = OpenAIEmbeddings(
-        model=os.getenv("OPENAI_EMBEDDING_MODEL", "text-embedding-3-small"),
-        api_key=openai_api_key
-    )
+    embedding_model = os.getenv("OPENAI_EMBEDDING_MODEL", "text-embedding-3-small")
+    
+    # One keep-alive HTTP/2 connection pool for every embedding request, closed once ingestion finishes
+    http_client = httpx.Client(http2=True, limits=HTTP_LIMITS)
+    http_async_client = httpx.AsyncClient(http2=True, limits=HTTP_LIMITS)
+    embeddings = create_embeddings(embedding_model, openai_api_key, http_client, http_async_client)
     
     # Setup ChromaDB
     chroma_db_path = Path(__file__).parent.parent / "vector_store" / "chroma_db_single"
@@ -72,33 +207,22 @@ def main():
     
     print(f"Found {len(csv_files)} CSV files to process")
     
-    all_documents = []
-    
-    # Process each CSV file
-    for csv_file in tqdm(csv_files, desc="Processing CSV files"):
-        try:
-            documents = load_csv_as_documents(str(csv_file))
-            all_documents.extend(documents)
-            print(f"  Loaded {len(documents)} documents from {csv_file.name}")
-        except Exception as e:
-            print(f"  Error processing {csv_file.name}: {e}")
-    
-    if not all_documents:
-        print("No documents to ingest")
-        return
-    
-    print(f"\nIngesting {len(all_documents)} documents into ChromaDB...")
+    print("\nIngesting documents into ChromaDB...")
     
-    # Add all documents to the vector store with progress bar
+    # Stream rows from every CSV file and add them to the vector store in concurrent batches
     try:
-        batch_size = 100
-        total_batches = len(all_documents) // batch_size + (1 if len(all_documents) % batch_size else 0)
+        # Chroma commits one SQLite transaction per write, so bulk loads use the largest batch it accepts
+        batch_size = vector_store._client.get_max_batch_size() if args.bulk_load else CHROMA_BATCH_SIZE
+        row_counts = {}
+        batches = ([list(column) for column in zip(*batch)] for batch in batched(iter_rows(csv_files, row_counts), batch_size))
+        with http_client:
+            ingested = asyncio.run(close_after(http_async_client, ingest_async(batches, vector_store, embeddings)))
         
-        for i in tqdm(range(0, len(all_documents), batch_size), desc="Ingesting documents", total=total_batches):
-            batch = all_documents[i:i+batch_size]
-            vector_store.add_documents(batch)
+        # Ids are row positions, so a file that shrank leaves its old tail behind
+        for source, row_count in row_counts.items():
+            delete_rows_past_end(vector_store._collection, source, row_count)
         
-        print(f"Successfully ingested {len(all_documents)} documents")
+        print(f"Successfully ingested {ingested} new or changed documents")
         print(f"ChromaDB persisted to: {chroma_db_path}")
     except Exception as e:
         print(f"Error ingesting documents: {e}")